@@ -15,96 +15,270 @@ Options:
 """
 
 import datetime
+import itertools
+import json
 import logging
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import BinaryIO, Optional
 
-import dateparser
 import lxml
-import lxml.html
-import requests
+import lxml.etree
 from docopt import docopt
 from dotenv import load_dotenv
 from requests import Session, exceptions
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
+CLUBS_URLS = [
+    "https://matchs.tv/club/real-madrid",
+    "https://matchs.tv/club/fc-barcelone",
+    "https://matchs.tv/club/manchester-city",
+    "https://matchs.tv/club/liverpool",
+    "https://matchs.tv/club/bayern-munich",
+]
+
+# Details about a match; dt is the parsed date, only set once date has been parsed (see parse_date_fr)
+Match = namedtuple("Match", "date hour teams competition id dt", defaults=[None])
+
+# Where to store validators and parsed matches of club pages, to skip unmodified pages on next runs
+HTTP_CACHE_FILE = Path(__file__).with_name(".http_cache.json")
+# To be incremented when parse_details output changes, so that matches cached by previous versions are ignored
+HTTP_CACHE_VERSION = 1
+
+SMS_BASE_URL = "https://smsapi.free-mobile.fr/sendmsg"
+# Maximum length of messages accepted by SMS API
+SMS_MAX_LENGTH = 999
+
+logger = logging.getLogger(__name__)
+
+# Setup requests session, shared by all requests to benefit from keep-alive connections pooling
+# and retry mechanism
+REQUESTS_SESSION = Session()
+# http://www.coglib.com/~icordasc/blog/2014/12/retries-in-requests.html
+# backoff_factor=2 will make sleep for 2 * (2 ^ (retry_number - 1)), ie 0, 2, 4, 8, 16, 32 ... up to 1 hour (for total=12)
+requests_retry = Retry(
+    total=15, backoff_factor=2, status_forcelist=[500, 501, 502, 503, 504]
+)  # retry when server return ont of this statuses
+requests_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=requests_retry)
+REQUESTS_SESSION.mount("http://", requests_adapter)
+REQUESTS_SESSION.mount("https://", requests_adapter)
+# SMS API requests must not be retried, as each retry could send the same SMS again
+REQUESTS_SESSION.mount(SMS_BASE_URL, HTTPAdapter(max_retries=0))
+
+# XPath expressions used to parse html pages, compiled once
+XPATH_HOUR = lxml.etree.XPath(".//td[@class='date']")
+XPATH_TEAMS = lxml.etree.XPath(".//td[@class='fixture']/h4")
+XPATH_COMPETITION = lxml.etree.XPath(".//div[@class='competitions']")
+
+MONTHS_FR = {
+    "janvier": 1,
+    "février": 2,
+    "mars": 3,
+    "avril": 4,
+    "mai": 5,
+    "juin": 6,
+    "juillet": 7,
+    "août": 8,
+    "septembre": 9,
+    "octobre": 10,
+    "novembre": 11,
+    "décembre": 12,
+}
+
 
 def elem_content(e):
-    return e.text_content().strip()
+    return "".join(e.itertext()).strip()
 
 
-def parse_details(url: str):
-    """Get url and parse html page to extract match details.
+def is_in_container(e) -> bool:
+    """Check if element is inside the matches container div (walking through ancestors is cheaper than
+    evaluating an XPath expression)."""
+    return any(div.get("class") == "container" for div in e.iterancestors("div"))
+
+
+def free_element(e) -> None:
+    """Free memory used by an element which has been entirely parsed and used, as well as everything parsed
+    before it (ie preceding siblings of element and of its ancestors)."""
+    e.clear()
+    for node in itertools.chain([e], e.iterancestors()):
+        while node.getprevious() is not None:
+            del node.getparent()[0]
+
+
+def load_http_cache() -> dict:
+    """Load HTTP cache from HTTP_CACHE_FILE, or return an empty one if it doesn't exist (or is invalid).
+    HTTP cache is a dict indexed by url, containing validators sent back by server (ETag and
+    Last-Modified headers) and matches parsed from html page, along with HTTP_CACHE_VERSION and year
+    used to parse them. Example:
+    {
+        'https://matchs.tv/club/real-madrid': {
+            'version': 1,
+            'year': 2025,
+            'etag': '"5f3c-63f0b2a1"',
+            'last_modified': 'Wed, 18 Jun 2025 08:00:00 GMT',
+            'matches': [{'date': 'mercredi 18 juin', ...}, ...],  # Match as dicts
+        }, ...
+    }
+    """
+    try:
+        return json.loads(HTTP_CACHE_FILE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_http_cache(http_cache: dict) -> None:
+    """Save HTTP cache to HTTP_CACHE_FILE, through a temporary file so that an interrupted run can't leave
+    a truncated file. Failures are only logged, as HTTP cache is not required to run."""
+    tmp_file = HTTP_CACHE_FILE.with_suffix(".tmp")
+    try:
+        tmp_file.write_text(json.dumps(http_cache))
+        tmp_file.replace(HTTP_CACHE_FILE)
+    except OSError as e:
+        logger.warning("Unable to save HTTP cache to %s: %s", HTTP_CACHE_FILE, e)
+
+
+def scrap_club(url: str, http_cache: dict, year: int):
+    """Get url and parse html page to extract match details (see parse_details).
     Make use of global REQUESTS_SESSION to benefit from retry mechanism.
-    Return an array of dicts containing details about given matchs
+    Response is streamed to the parser, so html page is parsed while being downloaded.
+    Page is requested conditionally using validators from http_cache; if page was not modified since
+    last run, cached matches are returned without downloading nor parsing it. Otherwise, http_cache
+    is updated. Cached matches parsed by another version of parse_details or for another year are ignored.
+    """
+    logger.info("-> %s ...", url)
+    cached = http_cache.get(url, {})
+    if cached.get("version") != HTTP_CACHE_VERSION or cached.get("year") != year:
+        cached = {}
+    headers = {}
+    if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    with REQUESTS_SESSION.get(url, headers=headers, stream=True) as res:
+        if res.status_code == 304:
+            logger.info("-> %s not modified, using cached matches", url)
+            return [Match(**match) for match in cached["matches"]]
+        res.raw.decode_content = True  # let urllib3 decompress gzipped content
+        matches = parse_details(res.raw, year)
+    etag = res.headers.get("ETag")
+    last_modified = res.headers.get("Last-Modified")
+    if res.status_code == 200 and (etag or last_modified):
+        http_cache[url] = {
+            "version": HTTP_CACHE_VERSION,
+            "year": year,
+            "etag": etag,
+            "last_modified": last_modified,
+            "matches": [match._asdict() for match in matches],
+        }
+    return matches
+
+
+def parse_details(page: BinaryIO, year: int):
+    """Parse html page to extract match details.
+    Return an array of Match containing details about given matchs
     Args:
-        elems: array of tr from html page
+        page: file-like object to read html page from
+        year: current year, used to build matchs ids
     Returns:
-        array of dicts
+        array of Match
     Example:
-    [{
-        'date': 'mercredi 18 juin',
-        'hour': '21h00',
-        'teams': 'Real Madrid - Al-Hilal',
-        'competition': 'Coupe du Monde des Clubs, Match de groupe 1',
-        'id': 'mercredi 18 juin 2025 — 21h00 — Real Madrid - Al-Hilal',
-    }, ... ]
+    [Match(
+        date='mercredi 18 juin',
+        hour='21h00',
+        teams='Real Madrid - Al-Hilal',
+        competition='Coupe du Monde des Clubs, Match de groupe 1',
+        id='mercredi 18 juin 2025 — 21h00 — Real Madrid - Al-Hilal',
+        dt=None,
+    ), ... ]
     """
-    # Fetch html page
-    print(f"-> {url} ...")
-    res = REQUESTS_SESSION.get(url)
-    xml_tree = lxml.html.document_fromstring(res.content)
-    page_tables = xml_tree.xpath("//div[@class='container']//table")
-    if len(page_tables) == 0:
-        return []  # No matchs found
-    elif len(page_tables) == 1:
-        table = page_tables[0]
-    elif len(page_tables) == 2:
-        table = page_tables[1]  # If there are 2 tables, the first one is for today or past matchs
-    else:
-        raise Exception(f"Unexpected number of tables in html page: {len(page_tables)}")
-    elems = table.xpath(".//tr")
-    # Browse through tr elements by groups of 2
+    # Parse html page incrementally: rows are extracted as soon as they are parsed, then freed along with
+    # everything parsed before them, so that only about one row is kept in memory.
+    # matchs.tv pages are utf-8 encoded, so skip encoding detection. Ids, blank text and comments are
+    # not used, so don't keep them in memory.
+    events = lxml.etree.iterparse(
+        page,
+        events=("start", "end"),
+        tag=("table", "tr"),
+        html=True,
+        encoding="utf-8",
+        remove_blank_text=True,
+        remove_comments=True,
+        collect_ids=False,
+    )
+    tables_count = 0
     res = []
-    elems_iter = iter(elems)
-    while True:
-        # Take tr two by two as html page is built like <tr>DATE</tr> <tr>MATCH DETAILS</tr>
-        try:
-            date = next(elems_iter)
-            details = next(elems_iter)
-        except StopIteration:
-            # No more matchs to parse
-            break
-        match = {
-            "date": elem_content(date[0]),
-            "hour": elem_content(details.xpath(".//td[@class='date']")[0]),
-            "teams": elem_content(details.xpath(".//td[@class='fixture']/h4")[0]),
-            "competition": elem_content(details.xpath(".//div[@class='competitions']")[0]),
-        }
-        match.update(
-            {"id": f"{match['date']} {datetime.date.today().year} — {match['hour']} — {match['teams']}"}
-        )
-        res.append(match)
+    date = None
+    for event, elem in events:
+        if event == "start":
+            if elem.tag == "table" and is_in_container(elem):
+                tables_count += 1
+                if tables_count > 2:
+                    raise Exception(f"Unexpected number of tables in html page: {tables_count}")
+                # If there are 2 tables, the first one is for today or past matchs
+                res = []
+                date = None
+            continue
+        if elem.tag == "tr" and is_in_container(elem):
+            # Take tr two by two as html page is built like <tr>DATE</tr> <tr>MATCH DETAILS</tr>
+            if date is None:
+                date = elem
+                continue  # Keep date row until details row is parsed
+            details = elem
+            match_date = elem_content(date[0])
+            hour = elem_content(XPATH_HOUR(details)[0])
+            teams = elem_content(XPATH_TEAMS(details)[0])
+            competition = elem_content(XPATH_COMPETITION(details)[0])
+            res.append(Match(match_date, hour, teams, competition, f"{match_date} {year} — {hour} — {teams}"))
+            date = None
+        free_element(elem)
     return res
 
 
-def parse_date_fr(date_str: str) -> datetime.datetime:
+def parse_date_fr(date_str: str, today: Optional[datetime.date] = None) -> datetime.datetime:
     """Parse a French date string like "mercredi 8 juin 2025" or "mercredi 8 juin"
     and return a datetime object.
     - raises an Exception if the date cannot be parsed
     - if year is not provided, next date occurring will be used
     - do not takes into account the first word (day of the week)
+    - today can be given to avoid getting current date on each call
+    >>> parse_date_fr("mercredi 18 juin 2025")
+    datetime.datetime(2025, 6, 18, 0, 0)
+    >>> parse_date_fr("dimanche 1er juin 2025")
+    datetime.datetime(2025, 6, 1, 0, 0)
+    >>> parse_date_fr("jeudi 15 janvier", datetime.date(2026, 10, 15))  # already passed: next year
+    datetime.datetime(2027, 1, 15, 0, 0)
+    >>> parse_date_fr("jeudi 15 octobre", datetime.date(2026, 10, 15))  # today: current year
+    datetime.datetime(2026, 10, 15, 0, 0)
     """
-    dt = dateparser.parse(date_str, settings={"PREFER_DATES_FROM": "future"}, languages=["fr"])
+    try:
+        parts = date_str.split()
+        day = int(parts[1].removesuffix("er"))
+        month = MONTHS_FR[parts[2].lower()]
+        if len(parts) > 3:
+            return datetime.datetime(int(parts[3]), month, day)
+        today = today or datetime.date.today()
+        dt = datetime.datetime(today.year, month, day)
+        if dt.date() < today:
+            # Date already passed this year, so it's next year's one
+            dt = dt.replace(year=today.year + 1)
+        return dt
+    except (IndexError, KeyError, ValueError):
+        # Unexpected format, fallback to (slower) generic parser, imported only when needed as
+        # importing it is slow
+        import dateparser
+
+        dt = dateparser.parse(date_str, settings={"PREFER_DATES_FROM": "future"}, languages=["fr"])
     if not dt:
         raise Exception("Unparsed date")
     return dt
 
 
-def is_in_more_than_one_week(dt: datetime.datetime) -> bool:
+def is_in_more_than_one_week(dt: datetime.datetime, now: Optional[datetime.datetime] = None) -> bool:
     """
-    Check if the given date is more than one week from now.
+    Check if the given date is more than one week from now (current time is used if now is not given).
     >>> from datetime import datetime, timedelta
     >>> now = datetime.now()
     >>> is_in_more_than_one_week(now + timedelta(days=10))
@@ -114,16 +288,21 @@ def is_in_more_than_one_week(dt: datetime.datetime) -> bool:
     >>> is_in_more_than_one_week(now + timedelta(days=3))
     False
     """
-    diff = dt - datetime.datetime.now()
+    diff = dt - (now or datetime.datetime.now())
     return diff > datetime.timedelta(days=7)
 
 
+def format_match(match: Match) -> str:
+    return f"- {match.date} {match.hour} — {match.teams} — {match.competition}"
+
+
 def send_sms(message: str) -> None:
-    sms_base_url = "https://smsapi.free-mobile.fr/sendmsg"
+    """Send message by SMS, truncated to SMS_MAX_LENGTH (longer messages are rejected by SMS API).
+    Message is url-encoded by requests."""
     sms_user = os.getenv("SMSAPI_USER")
     sms_pass = os.getenv("SMSAPI_PASS")
-    sms_url = f"{sms_base_url}?user={sms_user}&pass={sms_pass}&msg={message}"
-    response = requests.get(sms_url)
+    params = {"user": sms_user, "pass": sms_pass, "msg": message[:SMS_MAX_LENGTH]}
+    response = REQUESTS_SESSION.get(SMS_BASE_URL, params=params)
     if response.status_code == 200:
         print(f"SMS sent successfully")
     else:
@@ -132,37 +311,36 @@ def send_sms(message: str) -> None:
 
 def scrap_matches(let_send_sms: bool = True) -> None:
     """Scrap matches from matchs.tv and send SMS for upcoming matches within one week."""
-    # Scraping
-    matches = parse_details("https://matchs.tv/club/real-madrid")
-    matches += parse_details("https://matchs.tv/club/fc-barcelone")
-    matches += parse_details("https://matchs.tv/club/manchester-city")
-    matches += parse_details("https://matchs.tv/club/liverpool")
-    matches += parse_details("https://matchs.tv/club/bayern-munich")
-    print("All matches:")
-    for match in matches:
-        print(f"- {match['date']} {match['hour']} — {match['teams']} — {match['competition']}")
-    print("")
-    filtered_matches = [
-        match for match in matches if not is_in_more_than_one_week(parse_date_fr(match["date"]))
-    ]
+    # Get current time once, so that all matches are handled consistently
+    now = datetime.datetime.now()
+    # Scraping (pages are fetched concurrently, as fetching is network bound). Each page is parsed in its
+    # fetching thread while being downloaded, so parsing overlaps with other pages downloads. Matches are
+    # gathered in clubs order, so that output doesn't depend on network timing.
+    http_cache = load_http_cache()
+    matches = []
+    with ThreadPoolExecutor(max_workers=len(CLUBS_URLS)) as executor:
+        for club_matches in executor.map(lambda url: scrap_club(url, http_cache, now.year), CLUBS_URLS):
+            matches += club_matches
+    save_http_cache(http_cache)
+    # Remove duplicates (a match between two followed clubs appears on both clubs pages)
+    matches = list({match.id: match for match in matches}.values())
+    # Print each listing at once, rather than line by line
+    print("\n".join(["All matches:"] + [format_match(match) for match in matches] + [""]))
+    # Parse dates once, as they are used both for filtering and sorting
+    matches = [match._replace(dt=parse_date_fr(match.date, now.date())) for match in matches]
+    filtered_matches = [match for match in matches if not is_in_more_than_one_week(match.dt, now)]
     if filtered_matches:
         # Sort by date
-        filtered_matches.sort(key=lambda m: parse_date_fr(m["date"]))
-        print("Upcoming matches (filtered):")
-        matches_str = "\n".join(
-            [
-                f"- {match['date']} {match['hour']} — {match['teams']} — {match['competition']}"
-                for match in filtered_matches
-            ]
-        )
-        print(matches_str)
-        if let_send_sms:
-            send_sms(requests.utils.quote(f"Prochains matchs:\n{matches_str}"))
+        filtered_matches.sort(key=lambda m: m.dt)
+        matches_str = "\n".join([format_match(match) for match in filtered_matches])
+        print(f"Upcoming matches (filtered):\n{matches_str}")
+        message = f"Prochains matchs:\n{matches_str}"
     else:
         message = "No upcoming matches within one week."
         print(message)
-        if let_send_sms:
-            send_sms(requests.utils.quote(message))
+    # Send all upcoming matches in a single SMS
+    if let_send_sms:
+        send_sms(message)
 
 
 if __name__ == "__main__":
@@ -177,16 +355,6 @@ if __name__ == "__main__":
             raise EnvironmentError(f"Missing required environment variable: {var}")
     # Setup logging
     logging.basicConfig(level=logging.INFO)
-    logger = logging.getLogger(__name__)
-    # Setup requests with retry mechanism
-    REQUESTS_SESSION = Session()
-    # http://www.coglib.com/~icordasc/blog/2014/12/retries-in-requests.html
-    # backoff_factor=2 will make sleep for 2 * (2 ^ (retry_number - 1)), ie 0, 2, 4, 8, 16, 32 ... up to 1 hour (for total=12)
-    requests_retry = Retry(
-        total=15, backoff_factor=2, status_forcelist=[500, 501, 502, 503, 504]
-    )  # retry when server return ont of this statuses
-    REQUESTS_SESSION.mount("http://", HTTPAdapter(max_retries=requests_retry))
-    REQUESTS_SESSION.mount("https://", HTTPAdapter(max_retries=requests_retry))
     # Makes urllib warn about connections errors and retries
     urllib3_logger = logging.getLogger("urllib3.connectionpool")
     urllib3_logger.setLevel(logging.INFO)
@@ -198,6 +366,6 @@ if __name__ == "__main__":
         if args["--catch-exceptions"]:
             print(f"Exception occurred: {e}")
             if not args["--no-sms"]:
-                send_sms(requests.utils.quote(f"Error in matchs.tv script: {e}"))
+                send_sms(f"Error in matchs.tv script: {e}")
         else:
             raise e